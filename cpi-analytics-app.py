@@ -1,9 +1,12 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
+from itertools import cycle
+import json
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -15,13 +18,12 @@ st.set_page_config(
     layout="wide",
 )
 
-# Snowflakeセッションの取得
-try:
+# Snowflakeセッションの取得（リラン毎に取り直さず、プロセス内で共有する）
+@st.cache_resource
+def get_session():
+    """アクティブなSnowflakeセッションを返す（取得できない場合は例外）"""
     from snowflake.snowpark.context import get_active_session
-    session = get_active_session()
-    SNOWFLAKE_AVAILABLE = True
-except Exception:
-    SNOWFLAKE_AVAILABLE = False
+    return get_active_session()
 
 
 # --- カスタムCSSによるデザイン刷新 ---
@@ -102,143 +104,264 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- 表示用HTML（リランの度に文字列を組み立て直さないようモジュール定数にする） ---
+CONTRIBUTION_INFO_HTML = """
+<div class="info-box">
+このチャートは、総合CPI（前年同月比）がどの構成要素（エネルギー、食品、コア財、コアサービス）によって変動したかを示します。
+棒グラフは各項目の「寄与度」を表し、それらの合計が総合CPIの動きと連動します。
+</div>
+"""
+
+AI_INFO_HTML = """
+<div class="info-box">
+SnowflakeのCortex AI関数を活用し、データから専門的な洞察を自動生成します。<br>
+- <b>全体サマリー分析</b>: <code>AI_COMPLETE</code>を使い、主要KPIからマクロ経済の示唆を導出します。<br>
+- <b>複数項目の一括分析</b>: <code>AI_AGG</code>を使い、選択した全項目のトレンドを一度のクエリで個別に分析します。
+</div>
+"""
+
+AI_SUMMARY_HTML = '<div class="ai-analysis-box" style="white-space: pre-wrap;">{body}</div>'
+
+AI_AGG_RESULT_HTML = (
+    '<div class="ai-analysis-box" style="margin-bottom: 1rem; white-space: pre-wrap;">'
+    '<h5 style="margin-top:0; margin-bottom: 0.5rem;">{title}</h5>{body}'
+    '</div>'
+)
+
+# --- 分析で使用する主要CPI項目 ---
+MAJOR_CPI_PRODUCTS = (
+    "All items",
+    "All items less food and energy",
+    "Food",
+    "Energy",
+    "Commodities less food and energy commodities",
+    "Services less energy services",
+)
+
+# AI_AGGの分析対象として選択肢に並べる項目（表示順は主要CPI項目と異なり、サービスを財より先に置く）
+AI_AGG_PRODUCTS = (
+    "All items",
+    "All items less food and energy",
+    "Food",
+    "Energy",
+    "Services less energy services",
+    "Commodities less food and energy commodities",
+)
+
+# KPIとして最新値を表示する項目と表示ラベル
+KPI_PRODUCTS = (
+    ("All items", "総合CPI"),
+    ("All items less food and energy", "コアCPI"),
+    ("Food", "食品"),
+    ("Energy", "エネルギー"),
+)
+
+# 寄与度分析のカテゴリ（ウェイト・対応するCPI項目・表示色）
+CONTRIBUTION_CATEGORIES = {
+    "Core Services": {"weight": 0.58, "product_name": "Services less energy services", "color": "#1E90FF"},
+    "Core Goods": {"weight": 0.20, "product_name": "Commodities less food and energy commodities", "color": "#4682B4"},
+    "Food": {"weight": 0.14, "product_name": "Food", "color": "#32CD32"},
+    "Energy": {"weight": 0.08, "product_name": "Energy", "color": "#FF6347"}
+}
+
+# 寄与度チャートで積み上げる順序（下から）
+CONTRIBUTION_CATEGORY_ORDER = ("Energy", "Food", "Core Goods", "Core Services")
+
+# --- Snowflakeクエリ実行ヘルパー ---
+def fetch_arrow_table(query, params=None):
+    """クエリ結果をpandasを経由せずArrowテーブルとして取得する（paramsは ? にバインド）"""
+    cur = get_session().connection.cursor()
+    try:
+        cur.execute(query, params)
+        # 結果が0行でもNoneではなく、列スキーマを持つ空のテーブルを受け取る
+        return cur.fetch_arrow_all(force_return_table=True)
+    finally:
+        cur.close()
+
+# 文字列列はArrow-backedのままpandasに渡し、Pythonのstrオブジェクト配列を作らない
+ARROW_STRING_DTYPES = {
+    pa.string(): pd.StringDtype('pyarrow'),
+    pa.large_string(): pd.StringDtype('pyarrow'),
+}
+
+def arrow_to_pandas(table):
+    """ArrowテーブルをpandasのDataFrameに一度だけ変換する"""
+    return table.to_pandas(
+        split_blocks=True,
+        self_destruct=True,
+        types_mapper=ARROW_STRING_DTYPES.get,
+    )
+
 @st.cache_data(ttl=600)
 def load_cpi_attributes():
     """アプリで使用可能な全てのCPI属性リストを取得する"""
-    if not SNOWFLAKE_AVAILABLE:
-        return pd.DataFrame()
     query = """
     SELECT DISTINCT PRODUCT
     FROM FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_ATTRIBUTES
     WHERE REPORT = 'Consumer Price Index'
       AND FREQUENCY = 'Monthly'
       AND SEASONALLY_ADJUSTED = TRUE
-      AND PRODUCT IS NOT NULL;
+      AND PRODUCT IS NOT NULL
+    ORDER BY PRODUCT;
     """
     try:
-        return session.sql(query).to_pandas()
+        table = fetch_arrow_table(query)
+        return arrow_to_pandas(table)
     except Exception as e:
         st.error(f"CPI属性データの取得に失敗しました: {e}")
         return pd.DataFrame()
 
 # --- データ取得関数 (Snowflake) ---
-@st.cache_data(ttl=600)
 def load_cpi_timeseries_data(start_date, end_date):
     """寄与度分析とトレンド分析に必要なCPI時系列データをまとめて取得"""
-    if not SNOWFLAKE_AVAILABLE:
-        return pd.DataFrame()
 
     # YoY計算のために13ヶ月前からデータを取得
     extended_start_date = pd.to_datetime(start_date) - pd.DateOffset(months=13)
 
-    query = f"""
-    SELECT
-        ts.DATE,
-        ts.VALUE,
-        attr.PRODUCT,
-        attr.SEASONALLY_ADJUSTED
-    FROM FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_TIMESERIES ts
-    JOIN FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_ATTRIBUTES attr
-      ON ts.VARIABLE = attr.VARIABLE
-    WHERE attr.REPORT = 'Consumer Price Index'
-      AND attr.FREQUENCY = 'Monthly'
-      AND attr.SEASONALLY_ADJUSTED = TRUE
-      AND ts.DATE BETWEEN '{extended_start_date.strftime('%Y-%m-%d')}' AND '{end_date.strftime('%Y-%m-%d')}'
-      AND attr.PRODUCT IN (
-          'All items', 'All items less food and energy', 'Food', 'Energy',
-          'Services less energy services', 'Commodities less food and energy commodities'
-      )
-      AND ts.VALUE IS NOT NULL
-    ORDER BY attr.PRODUCT, ts.DATE
+    # 月次データは各月1日付けなので、期間を月初に揃えても取得される行は変わらない
+    # 日付の細かな違い（日々変わる「今日」など）でキャッシュが分かれないよう、正規化してから渡す
+    range_start = extended_start_date + pd.offsets.MonthBegin(0)
+    display_start = pd.to_datetime(start_date) + pd.offsets.MonthBegin(0)
+    range_end = pd.to_datetime(end_date).to_period('M').to_timestamp()
+    return fetch_cpi_timeseries(
+        range_start.strftime('%Y-%m-%d'),
+        display_start.strftime('%Y-%m-%d'),
+        range_end.strftime('%Y-%m-%d'),
+    )
+
+@st.cache_data(ttl=600)
+def fetch_cpi_timeseries(range_start, display_start, range_end):
+    """指定期間（YYYY-MM-DD）のCPI時系列データを取得（range_startからはYoY計算用の先行期間）"""
+    # バインド変数を使い、クエリ文字列を固定してSnowflakeのプランを再利用させる
+    # YoY/MoMはウィンドウ関数でSnowflake側で計算する（月次データなので12行前 = 前年同月）
+    # 計算に使った先行期間の行はSnowflake側で落とし、表示期間の行だけを転送する
+    query = """
+    WITH cpi AS (
+        SELECT
+            ts.DATE,
+            ts.VALUE,
+            attr.PRODUCT,
+            attr.SEASONALLY_ADJUSTED,
+            -- 同じPRODUCT名を持つ別系列が混ざらないよう、系列(VARIABLE)単位でLAGを取る
+            ((ts.VALUE / NULLIF(LAG(ts.VALUE, 12) OVER (PARTITION BY ts.VARIABLE ORDER BY ts.DATE), 0) - 1) * 100)::FLOAT AS "YoY_Change",
+            ((ts.VALUE / NULLIF(LAG(ts.VALUE, 1) OVER (PARTITION BY ts.VARIABLE ORDER BY ts.DATE), 0) - 1) * 100)::FLOAT AS "MoM_Change"
+        FROM FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_TIMESERIES ts
+        JOIN FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_ATTRIBUTES attr
+          ON ts.VARIABLE = attr.VARIABLE
+        WHERE attr.REPORT = 'Consumer Price Index'
+          AND attr.FREQUENCY = 'Monthly'
+          AND attr.SEASONALLY_ADJUSTED = TRUE
+          AND ts.DATE BETWEEN ?::DATE AND ?::DATE
+          AND attr.PRODUCT IN (SELECT VALUE::STRING FROM TABLE(FLATTEN(INPUT => PARSE_JSON(?))))
+          AND ts.VALUE IS NOT NULL
+    )
+    SELECT * FROM cpi
+    WHERE DATE >= ?::DATE
+    ORDER BY PRODUCT, DATE
     """
+    params = [range_start, range_end, json.dumps(MAJOR_CPI_PRODUCTS), display_start]
     try:
-        df = session.sql(query).to_pandas()
-        if not df.empty:
-            df['DATE'] = pd.to_datetime(df['DATE'])
-            df = df.sort_values(by=['PRODUCT', 'DATE'])
-            # YoY と MoM を事前に計算
-            df['YoY_Change'] = df.groupby('PRODUCT')['VALUE'].pct_change(periods=12) * 100
-            df['MoM_Change'] = df.groupby('PRODUCT')['VALUE'].pct_change(periods=1) * 100
-        return df
+        table = fetch_arrow_table(query, params)
+        if table.num_rows > 0:
+            # 型変換はArrow上で行い、pandasへの変換は一度だけにする
+            table = table.set_column(
+                table.schema.get_field_index('DATE'), 'DATE',
+                pc.cast(table['DATE'], pa.timestamp('ns'))
+            )
+            table = table.set_column(
+                table.schema.get_field_index('VALUE'), 'VALUE',
+                pc.cast(table['VALUE'], pa.float64())
+            )
+            # 繰り返しの多いPRODUCTは辞書エンコードし、pandasではcategory型として受け取る
+            table = table.set_column(
+                table.schema.get_field_index('PRODUCT'), 'PRODUCT',
+                pc.dictionary_encode(table['PRODUCT'])
+            )
+        return arrow_to_pandas(table)
     except Exception as e:
         st.error(f"CPI時系列データの取得に失敗しました: {e}")
         return pd.DataFrame()
 
 
 # --- 分析・計算関数 ---
-@st.cache_data(ttl=600)
-def calculate_contribution_data(_df, start_date):
+def timeseries_fingerprint(df):
+    """キャッシュキー用に、DataFrameをpickleせず軽量な識別子を返す"""
+    if df.empty:
+        return (0,)
+    # 行数や期間が同じでも値が異なれば別のキーになるよう、ベクトル化した行ハッシュの合計を含める
+    value_hash = int(pd.util.hash_pandas_object(df, index=False).sum())
+    return (len(df), tuple(df.columns), str(df['DATE'].min()), str(df['DATE'].max()), value_hash)
+
+# 時系列DataFrameを受け取るキャッシュ関数で共通して使うハッシュ関数
+TIMESERIES_HASH_FUNCS = {pd.DataFrame: timeseries_fingerprint}
+
+@st.cache_data(ttl=600, hash_funcs=TIMESERIES_HASH_FUNCS)
+def calculate_contribution_data(df):
     """CPI寄与度を計算"""
-    if _df.empty:
+    if df.empty:
         return pd.DataFrame()
 
-    categories = {
-        "Core Services": {"weight": 0.58, "product_name": "Services less energy services", "color": "#1E90FF"},
-        "Core Goods": {"weight": 0.20, "product_name": "Commodities less food and energy commodities", "color": "#4682B4"},
-        "Food": {"weight": 0.14, "product_name": "Food", "color": "#32CD32"},
-        "Energy": {"weight": 0.08, "product_name": "Energy", "color": "#FF6347"}
-    }
-    
+    # 項目ごとの抽出は一度の分割で済ませる
+    product_groups = split_by_product(df)
+    empty_df = df.iloc[0:0]
+
     # 寄与度を計算
     contribution_dfs = []
-    for category, props in categories.items():
-        cat_df = _df[_df['PRODUCT'] == props['product_name']].copy()
-        cat_df['Contribution'] = cat_df['YoY_Change'] * props['weight']
-        cat_df['Category'] = category
-        cat_df['Color'] = props['color']
-        contribution_dfs.append(cat_df[['DATE', 'Category', 'Contribution', 'Color']])
-
-    result_df = pd.concat(contribution_dfs)
+    for category, props in CONTRIBUTION_CATEGORIES.items():
+        cat_df = product_groups.get(props['product_name'])
+        if cat_df is None:
+            continue
+        contribution_dfs.append(cat_df[['DATE']].assign(
+            Category=category,
+            Contribution=cat_df['YoY_Change'] * props['weight']
+        ))
+
+    if not contribution_dfs:
+        return pd.DataFrame()
+    result_df = pd.concat(contribution_dfs, ignore_index=True)
     
-    # 全項目とコアCPIのYoY変化率をマージ
-    all_items_yoy = _df[_df['PRODUCT'] == 'All items'][['DATE', 'YoY_Change']].rename(columns={'YoY_Change': 'All_Items_YoY'})
-    core_cpi_yoy = _df[_df['PRODUCT'] == 'All items less food and energy'][['DATE', 'YoY_Change']].rename(columns={'YoY_Change': 'Core_CPI_YoY'})
+    # 全項目とコアCPIのYoY変化率は計算済みの列を日付で引き当てるだけ
+    # （'All items' と コアCPI は MAJOR_CPI_PRODUCTS として常に取得している）
+    all_items_yoy = product_groups.get('All items', empty_df).set_index('DATE')['YoY_Change']
+    core_cpi_yoy = product_groups.get('All items less food and energy', empty_df).set_index('DATE')['YoY_Change']
 
-    result_df = pd.merge(result_df, all_items_yoy, on='DATE', how='left')
-    result_df = pd.merge(result_df, core_cpi_yoy, on='DATE', how='left')
+    result_df['All_Items_YoY'] = result_df['DATE'].map(all_items_yoy)
+    result_df['Core_CPI_YoY'] = result_df['DATE'].map(core_cpi_yoy)
     
-    # NaNを除去し、表示期間でフィルタ
-    result_df = result_df.dropna(subset=['Contribution']).reset_index(drop=True)
-    return result_df[result_df['DATE'] >= pd.to_datetime(start_date)]
+    # NaNを除去（表示期間への絞り込みはクエリ側で済んでいる）
+    return result_df.dropna(subset=['Contribution']).reset_index(drop=True)
 
+@st.cache_data(ttl=600, hash_funcs=TIMESERIES_HASH_FUNCS)
+def build_detail_table(df, products):
+    """データ詳細タブ用に、選択項目の行を日付の新しい順に並べて返す"""
+    display_df = df[df['PRODUCT'].isin(products)]
 
-@st.cache_data(ttl=600)
-def calculate_inflation_metrics(df):
-    """DataFrameからインフレ指標（YoY, MoM）を計算して追加する"""
-    if df.empty:
-        return pd.DataFrame()
-    
-    # PRODUCT列が存在することを確認
-    if 'PRODUCT' not in df.columns:
-        st.warning("calculate_inflation_metrics: DataFrameにPRODUCT列がありません。")
-        return df
-
-    df = df.sort_values(by=['PRODUCT', 'DATE'])
-    # groupby().pct_change() を使ってPRODUCTごとに計算
-    df['YoY_Change'] = df.groupby('PRODUCT')['VALUE'].pct_change(periods=12) * 100
-    df['MoM_Change'] = df.groupby('PRODUCT')['VALUE'].pct_change(periods=1) * 100
-    return df
-
-def get_major_cpi_products():
-    """分析でよく使われる主要なCPI項目を返す"""
-    return [
-        "All items",
-        "All items less food and energy",
-        "Food",
-        "Energy",
-        "Commodities less food and energy commodities",
-        "Services less energy services"
-    ]
+    # 日付の新しい順に並び替え
+    sorted_df = display_df.sort_values(by="DATE", ascending=False)
+
+    # 修正点①: 古いインデックスをリセットして、1から始まる連番にする
+    return sorted_df.reset_index(drop=True)
+
+
+def split_by_product(df):
+    """DataFrameを 項目名 -> その項目の行 の辞書に分割する（項目の出現順を保持）"""
+    # 行の並びに依存せず、一度のgroupbyで分割する（数百行程度なのでコストは無視できる）
+    return dict(list(df.groupby('PRODUCT', sort=False, observed=True)))
 
-@st.cache_data
-def get_latest_metrics(_df):
+@st.cache_data(ttl=600, hash_funcs=TIMESERIES_HASH_FUNCS)
+def get_latest_metrics(df):
     """最新のKPI指標を取得"""
     metrics = {}
-    products_to_track = ['All items', 'All items less food and energy', 'Food', 'Energy']
+    products_to_track = [product for product, _ in KPI_PRODUCTS]
+    # 項目ごとの最新行は、日付順に並べてから一度の重複除去（各項目の最後の行を残す）で取り出す
+    latest_rows = (
+        df.sort_values('DATE', kind='stable')
+        .drop_duplicates(subset='PRODUCT', keep='last')
+        .set_index('PRODUCT')
+    )
     for product in products_to_track:
-        product_df = _df[_df['PRODUCT'] == product]
-        if not product_df.empty:
-            latest = product_df.iloc[-1]
+        if product in latest_rows.index:
+            latest = latest_rows.loc[product]
             metrics[product] = {
                 'YoY_Change': latest['YoY_Change'],
                 'MoM_Change': latest['MoM_Change'],
@@ -248,6 +371,15 @@ def get_latest_metrics(_df):
 
 
 # --- チャート生成の共通関数 ---
+# チャートに渡す数値の型（%表示で小数2桁なのでfloat32で十分。ブラウザへの転送量が半分になる）
+CHART_DTYPE = np.float32
+
+# 項目別の折れ線に使う配色（Plotly標準テンプレートと同じ並び）
+CHART_COLORS = (
+    '#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A',
+    '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52',
+)
+
 def get_professional_chart_layout(title, y_title, height=550):
     """Plotlyチャートのプロフェッショナルな共通レイアウトを生成"""
     return go.Layout(
@@ -263,20 +395,19 @@ def get_professional_chart_layout(title, y_title, height=550):
 
 def calculate_dynamic_yrange(data_series_list):
     """複数のデータシリーズから動的なY軸範囲を計算"""
-    valid_series = [s for s in data_series_list if s is not None and not s.empty]
-    if not valid_series:
+    # Series / NumPy配列のどちらも受け付け、pd.concatせずに一つの配列にまとめる
+    valid_arrays = [np.asarray(s, dtype=np.float64) for s in data_series_list if s is not None and len(s) > 0]
+    if not valid_arrays:
         return [-2, 10] # デフォルト
         
-    combined_series = pd.concat(valid_series).dropna()
+    combined = np.concatenate(valid_arrays)
+    # NaN・無限大などの無効な値はまとめて除外
+    combined = combined[np.isfinite(combined)]
     
-    if combined_series.empty:
+    if combined.size == 0:
         return [-2, 10]
     
-    min_val, max_val = combined_series.min(), combined_series.max()
-    
-    # 無効な値が混入している場合
-    if pd.isna(min_val) or pd.isna(max_val):
-         return [-2, 10]
+    min_val, max_val = float(combined.min()), float(combined.max())
 
     # 全て同じ値の場合
     if min_val == max_val:
@@ -307,35 +438,39 @@ def create_contribution_chart(contrib_df):
         return go.Figure()
 
     pivot_df = contrib_df.pivot(index='DATE', columns='Category', values='Contribution')
-    category_order = ["Energy", "Food", "Core Goods", "Core Services"]
+    dates = pivot_df.index.to_numpy()
     
-    fig = go.Figure()
-    for category in category_order:
+    # トレースはリストにまとめ、Figure生成時に一括で渡す
+    traces = []
+    for category in CONTRIBUTION_CATEGORY_ORDER:
         if category in pivot_df.columns:
-            color = contrib_df[contrib_df['Category'] == category]['Color'].iloc[0]
-            fig.add_trace(go.Bar(
+            traces.append(go.Bar(
                 name=category,
-                x=pivot_df.index,
-                y=pivot_df[category],
-                marker_color=color,
+                x=dates,
+                y=pivot_df[category].to_numpy(dtype=CHART_DTYPE),
+                marker_color=CONTRIBUTION_CATEGORIES[category]['color'],
                 hovertemplate=f'<b>{category}</b><br>Date: %{{x}}<br>Contribution: %{{y:.2f}}pp<extra></extra>'
             ))
             
-    line_data = contrib_df[['DATE', 'All_Items_YoY', 'Core_CPI_YoY']].drop_duplicates().set_index('DATE')
-    fig.add_trace(go.Scatter(
-        name='All Items CPI (YoY)', x=line_data.index, y=line_data['All_Items_YoY'],
+    # 参照線の値は同じ日付のカテゴリ間で共通なので、日付列だけで重複を除いて1日1行にする
+    line_data = contrib_df.drop_duplicates(subset='DATE')[['DATE', 'All_Items_YoY', 'Core_CPI_YoY']].set_index('DATE').sort_index()
+    line_dates = line_data.index.to_numpy()
+    traces.append(go.Scattergl(
+        name='All Items CPI (YoY)', x=line_dates, y=line_data['All_Items_YoY'].to_numpy(dtype=CHART_DTYPE),
         mode='lines+markers', line={'color': '#1E3A8A', 'width': 3}, marker_size=6,
         hovertemplate='<b>All Items CPI</b><br>YoY: %{y:.2f}%<extra></extra>'
     ))
-    fig.add_trace(go.Scatter(
-        name='Core CPI (YoY)', x=line_data.index, y=line_data['Core_CPI_YoY'],
+    traces.append(go.Scattergl(
+        name='Core CPI (YoY)', x=line_dates, y=line_data['Core_CPI_YoY'].to_numpy(dtype=CHART_DTYPE),
         mode='lines+markers', line={'color': '#DC2626', 'width': 3, 'dash': 'dash'}, marker_size=6,
         hovertemplate='<b>Core CPI</b><br>YoY: %{y:.2f}%<extra></extra>'
     ))
 
     # Y軸の範囲を動的に設定
-    positive_sums = pivot_df[pivot_df > 0].sum(axis=1)
-    negative_sums = pivot_df[pivot_df < 0].sum(axis=1)
+    # 正負それぞれの積み上げ合計は、マスク付きDataFrameを作らずNumPy上で計算する
+    contributions = pivot_df.to_numpy(dtype=np.float64)
+    positive_sums = np.where(contributions > 0, contributions, 0.0).sum(axis=1)
+    negative_sums = np.where(contributions < 0, contributions, 0.0).sum(axis=1)
     y_range = calculate_dynamic_yrange([
         positive_sums,
         negative_sums,
@@ -347,7 +482,7 @@ def create_contribution_chart(contrib_df):
     layout.barmode = 'relative'
     layout.yaxis.range = y_range
     layout.margin.t = 100
-    fig.update_layout(layout)
+    fig = go.Figure(data=traces, layout=layout)
 
     
     # ゼロラインを追加
@@ -367,79 +502,81 @@ def create_trends_chart(trends_df, chart_type='YoY'):
     title = f'主要CPI項目トレンド ({chart_type})'
     y_title = f'{chart_type} 変化率 (%)'
 
-    fig = px.line(
-        trends_df,
-        x='DATE',
-        y=value_col,
-        color='PRODUCT',
-        labels={'PRODUCT': '項目'},
-        markers=True
-    )
+    # 折れ線はWebGLで描画し、SVGのDOMノードを項目数×月数だけ作らないようにする
+    traces = [
+        go.Scattergl(
+            name=product,
+            x=product_df['DATE'].to_numpy(),
+            y=product_df[value_col].to_numpy(dtype=CHART_DTYPE),
+            mode='lines+markers',
+            line_color=color,
+            hovertemplate=f'<b>{product}</b><br>Date: %{{x}}<br>{chart_type}: %{{y:.2f}}%<extra></extra>'
+        )
+        for (product, product_df), color in zip(split_by_product(trends_df).items(), cycle(CHART_COLORS))
+    ]
     
     # Y軸の範囲を動的に計算
     y_range = calculate_dynamic_yrange([trends_df[value_col]])
     
     layout = get_professional_chart_layout(title, y_title)
     layout.yaxis.range = y_range
+    layout.legend.title = {'text': '項目'}
     
     # 上部マージンを広げてタイトルと凡例の重なりを解消
     layout.margin.t = 170 
     
-    fig.update_layout(layout)
+    fig = go.Figure(data=traces, layout=layout)
     fig.add_hline(y=0, line_width=1, line_color="gray")
     return fig
 
 
 # --- AI分析関数 (Snowflake Cortex) ---
+# LLM呼び出しは同じ入力なら結果を再利用する（失敗時は例外のためキャッシュされない）
+@st.cache_data(ttl=3600, show_spinner=False)
+def run_cortex_complete(ai_model, prompt):
+    """AI_COMPLETEを実行し、生成テキストを返す"""
+    # モデル名とプロンプトはバインド変数で渡す（1行の結果なのでcollectで取得）
+    query = "SELECT AI_COMPLETE(?, ?) AS analysis"
+    result = get_session().sql(query, params=[ai_model, prompt]).collect()
+    return result[0]['ANALYSIS']
+
 def run_ai_complete_analysis(metrics, ai_model):
     """
     AI分析を生成（専門的な経済分析）。
     参照コードのプロンプト形式を参考に再構成。
     """
-    if not SNOWFLAKE_AVAILABLE:
-        return "Snowflakeセッションが利用できません。"
     
     try:
-        # 分析データの要約を作成
-        analysis_summary = []
-        product_names = []
+        # 分析データはトークン数を抑えるためCSV形式の表にまとめる
+        summary_rows = ["項目,前年同月比(%),前月比(%)"]
         for product, metric_values in metrics.items():
             if metric_values:
-                product_names.append(product)
                 yoy = metric_values.get('YoY_Change', 0)
                 mom = metric_values.get('MoM_Change', 0)
-                analysis_summary.append(f"【{product}】\n- 前年同月比: {yoy:+.2f}%\n- 前月比: {mom:+.2f}%")
-        
-        summary_text = "\n".join(analysis_summary)
-
-        # 参照コードを基にした、より詳細なプロンプト
-        prompt = f"""
-        # 指示
-        あなたはウォール街のトップエコノミストです。提供された最新の米国CPIデータを基に、プロフェッショナルな経済分析レポートを日本語で作成してください。
-
-        # 分析対象データ
-        - 分析対象項目: {', '.join(product_names)}
-        - 最新の数値:
-        {summary_text}
-        
-        # レポートに含めるべき内容 (5点)
-        1. 各項目の価格動向の詳細な分析
-        2. インフレの主要な変動要因の特定
-        3. 経済全体へのインフレ圧力の根本的な評価
-        4. この結果が米連邦準備制度(FRB)の金融政策に与える示唆
-        5. 今後3～6ヶ月の見通しと主要なリスク要因
-
-        # 出力形式
-        - 各項目を明確に分けて、構造化された文章で記述してください。
-        - 専門用語を適切に使い、客観的でデータに基づいた分析を行ってください。
-        - 不要な改行は削除してください
-        """
-
-        safe_prompt = prompt.replace("'", "''")
-        query = f"SELECT AI_COMPLETE('{ai_model}', '{safe_prompt}') AS analysis"
-        result = session.sql(query).to_pandas()
-        
-        raw_analysis = result['ANALYSIS'].iloc[0]
+                summary_rows.append(f"{product},{yoy:+.2f},{mom:+.2f}")
+        summary_text = "\n".join(summary_rows)
+
+        # 参照コードを基にしたプロンプト（インデントの空白もトークンになるため行頭に詰めて記述）
+        prompt = f"""# 指示
+あなたはウォール街のトップエコノミストです。以下の最新の米国CPIデータを基に、プロフェッショナルな経済分析レポートを日本語で作成してください。
+
+# 分析対象データ（最新月）
+{summary_text}
+
+# レポートに含めるべき内容 (5点)
+1. 各項目の価格動向の詳細な分析
+2. インフレの主要な変動要因の特定
+3. 経済全体へのインフレ圧力の根本的な評価
+4. この結果が米連邦準備制度(FRB)の金融政策に与える示唆
+5. 今後3～6ヶ月の見通しと主要なリスク要因
+
+# 出力形式
+- 各項目を明確に分けて、構造化された文章で記述してください。
+- 専門用語を適切に使い、客観的でデータに基づいた分析を行ってください。
+- 不要な改行は削除してください
+"""
+
+        raw_analysis = run_cortex_complete(ai_model, prompt)
         formatted_analysis = raw_analysis.replace('\\n', '\n')
         return formatted_analysis
 
@@ -447,48 +584,74 @@ def run_ai_complete_analysis(metrics, ai_model):
         return f"Cortex AI (COMPLETE)の分析でエラーが発生しました: {str(e)}"
 
         
-def run_ai_agg_bulk_analysis(products_to_analyze, user_prompt):
-    """
-    AI_AGGとTRANSLATEを組み合わせ、ユーザー指定の観点で分析を実行する。
-    """
-    if not SNOWFLAKE_AVAILABLE or not products_to_analyze:
-        return pd.DataFrame()
-
-    product_list_str = "', '".join(products_to_analyze)
-    safe_user_prompt = user_prompt.replace("'", "''")
-
+@st.cache_data(ttl=3600, show_spinner=False)
+def run_ai_agg_query(products, user_prompt):
+    """AI_AGG + TRANSLATE のクエリを実行し、項目ごとの分析結果を返す"""
     # AI_AGGで英語で分析 -> TRANSLATEで日本語に翻訳するクエリ
-    query = f"""
+    # YoY/MoMはウィンドウ関数でSnowflake側で計算し、月次サマリーの行だけをAI_AGGに渡す
+    query = """
     WITH timeseries_data AS (
         SELECT
+            ts.VARIABLE,
             attr.PRODUCT,
             ts.DATE,
             ts.VALUE
         FROM FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_TIMESERIES ts
         JOIN FINANCE__ECONOMICS.CYBERSYN.BUREAU_OF_LABOR_STATISTICS_PRICE_ATTRIBUTES attr
           ON ts.VARIABLE = attr.VARIABLE
-        WHERE attr.PRODUCT IN ('{product_list_str}')
+        WHERE attr.REPORT = 'Consumer Price Index'
+          AND attr.PRODUCT IN (SELECT VALUE::STRING FROM TABLE(FLATTEN(INPUT => PARSE_JSON(?))))
           AND attr.FREQUENCY = 'Monthly'
           AND attr.SEASONALLY_ADJUSTED = TRUE
-          AND ts.DATE >= DATEADD(month, -24, CURRENT_DATE())
+          -- 24ヶ月分のYoYを計算するため、さらに12ヶ月前から取得
+          AND ts.DATE >= DATEADD(month, -36, CURRENT_DATE())
+          AND ts.VALUE IS NOT NULL
+    ),
+    monthly_summary AS (
+        SELECT
+            PRODUCT,
+            DATE,
+            VALUE,
+            -- 同じPRODUCT名を持つ別系列が混ざらないよう、系列(VARIABLE)単位でLAGを取る
+            (VALUE / NULLIF(LAG(VALUE, 12) OVER (PARTITION BY VARIABLE ORDER BY DATE), 0) - 1) * 100 AS YOY,
+            (VALUE / NULLIF(LAG(VALUE, 1) OVER (PARTITION BY VARIABLE ORDER BY DATE), 0) - 1) * 100 AS MOM
+        FROM timeseries_data
     )
     SELECT
         PRODUCT AS "項目名",
         SNOWFLAKE.CORTEX.TRANSLATE(
             AI_AGG(
-                CONCAT(TO_VARCHAR(DATE, 'YYYY-MM'), ': ', VALUE),
+                CONCAT(
+                    TO_VARCHAR(DATE, 'YYYY-MM'), ': ', ROUND(VALUE, 3),
+                    ' (YoY ', COALESCE(TO_VARCHAR(ROUND(YOY, 2)), 'n/a'), '%',
+                    ', MoM ', COALESCE(TO_VARCHAR(ROUND(MOM, 2)), 'n/a'), '%)'
+                ),
                 -- AI_AGGにはユーザーの質問を直接渡す
-                '{safe_user_prompt}'
+                ?
             ),
             'en', 'ja' -- 英語(en)から日本語(ja)へ翻訳
         ) AS "AIによるトレンド分析"
-    FROM timeseries_data
-    WHERE VALUE IS NOT NULL
+    FROM monthly_summary
+    WHERE DATE >= DATEADD(month, -24, CURRENT_DATE())
     GROUP BY PRODUCT;
     """
     
+    params = [json.dumps(list(products)), user_prompt]
+    return arrow_to_pandas(fetch_arrow_table(query, params))
+
+
+def run_ai_agg_bulk_analysis(products_to_analyze, user_prompt):
+    """
+    AI_AGGとTRANSLATEを組み合わせ、ユーザー指定の観点で分析を実行する。
+    """
+    if not products_to_analyze:
+        return pd.DataFrame()
+
     try:
-        result_df = session.sql(query).to_pandas()
+        # 選択順に関わらず同じバインド値になるよう並べ替え、キャッシュとSnowflakeの結果キャッシュを効かせる
+        result_df = run_ai_agg_query(tuple(sorted(set(products_to_analyze))), user_prompt)
+        if result_df.empty:
+            return result_df
         # 結果のクリーニング処理
         def clean_ai_output(text):
             if isinstance(text, str):
@@ -501,6 +664,12 @@ def run_ai_agg_bulk_analysis(products_to_analyze, user_prompt):
         st.error(f"Cortex AI (AI_AGG) の分析でエラーが発生しました: {e}")
         return pd.DataFrame()
         
+# --- エクスポート関数 ---
+@st.cache_data(ttl=600)
+def convert_df_to_csv(df):
+    """DataFrameをCSVのバイト列に変換（同じ内容であればリラン時に再エンコードしない）"""
+    return df.to_csv(index=False).encode('utf-8')
+
 # --- UI描画関数 ---
 def render_sidebar():
     """サイドバーのUIを構築・描画"""
@@ -528,32 +697,157 @@ def render_kpi_metrics(metrics):
         return
 
     st.markdown('<div class="section-title">📊 主要CPI指標（最新月）</div>', unsafe_allow_html=True)
-    cols = st.columns(4)
-    
-    with cols[0]:
-        st.metric(
-            label=f"総合CPI (YoY) | {metrics['All items']['Date']:%Y-%m}",
-            value=f"{metrics['All items']['YoY_Change']:.2f}%",
-            delta=f"{metrics['All items']['MoM_Change']:.2f}% vs 前月",
+    # 4項目は同じ形式なので、表示ラベルの定義から一括で描画する
+    cols = st.columns(len(KPI_PRODUCTS))
+    for col, (product, label) in zip(cols, KPI_PRODUCTS):
+        product_metrics = metrics.get(product)
+        if product_metrics is None:
+            continue
+        with col:
+            st.metric(
+                label=f"{label} (YoY) | {product_metrics['Date']:%Y-%m}",
+                value=f"{product_metrics['YoY_Change']:.2f}%",
+                delta=f"{product_metrics['MoM_Change']:.2f}% vs 前月",
+            )
+
+
+# 各タブは st.fragment として描画し、タブ内のウィジェット操作ではそのタブだけを再実行する
+@st.fragment
+def render_trends_section(full_df):
+    """主要トレンドタブを描画"""
+    st.markdown('<div class="section-title">主要項目の価格トレンド</div>', unsafe_allow_html=True)
+    chart_type = st.radio("表示する変化率", ["YoY", "MoM"], horizontal=True, key="trends_radio")
+
+    trends_chart = create_trends_chart(full_df, chart_type)
+    st.plotly_chart(trends_chart, use_container_width=True, key="trends_chart")
+
+
+@st.fragment
+def render_ai_insights(latest_metrics):
+    """AIによる洞察タブを描画"""
+    st.markdown('<div class="section-title">Cortex AIによる経済分析</div>', unsafe_allow_html=True)
+    st.markdown(AI_INFO_HTML, unsafe_allow_html=True)
+
+    col1, col2 = st.columns([1.2, 1]) 
+
+    with col1:
+        st.subheader("全体サマリー分析 (AI_COMPLETE)")
+
+        ai_model_complete = st.selectbox(
+            "🧠 使用するAIモデルを選択",
+            ["llama4-maverick", "claude-4-sonnet", "claude-3-5-sonnet", "mistral-large2"],
+            key="model_selector_complete"
         )
-    with cols[1]:
-        st.metric(
-            label=f"コアCPI (YoY) | {metrics['All items less food and energy']['Date']:%Y-%m}",
-            value=f"{metrics['All items less food and energy']['YoY_Change']:.2f}%",
-            delta=f"{metrics['All items less food and energy']['MoM_Change']:.2f}% vs 前月",
+
+        if st.button("🧠 サマリー分析を実行", key="ai_complete_button"):
+            with st.spinner(f"AI ({ai_model_complete}) が全体状況を分析中..."):
+                st.session_state.ai_summary = run_ai_complete_analysis(latest_metrics, ai_model_complete)
+
+        if 'ai_summary' in st.session_state:
+            st.markdown(AI_SUMMARY_HTML.format(body=st.session_state.ai_summary), unsafe_allow_html=True)
+
+    with col2:
+        st.subheader("複数項目の一括分析 (AI_AGG)")
+
+        # 分析観点の入力UI（参照コードを参考）
+        agg_input_type = st.radio(
+            "分析観点の指定方法:",
+            ["サンプルから選択", "自由入力"],
+            horizontal=True,
+            key="agg_input_type"
         )
-    with cols[2]:
-        st.metric(
-            label=f"食品 (YoY) | {metrics['Food']['Date']:%Y-%m}",
-            value=f"{metrics['Food']['YoY_Change']:.2f}%",
-            delta=f"{metrics['Food']['MoM_Change']:.2f}% vs 前月",
+
+        if agg_input_type == "サンプルから選択":
+            agg_prompts = [
+                "最近のトレンドを150字程度で要約して。",
+                "価格を押し上げている主な要因は何ですか？",
+                "価格を安定させている主な要因は何ですか？",
+                "この項目の価格変動は、他の経済指標（例：個人消費支出、生産者物価指数）にどのような影響を与えそうですか？",
+                "このデータは、FRBの次の金融政策決定会合（FOMC）にどのような影響を与えますか？"
+            ]
+            selected_agg_prompt = st.selectbox("分析観点を選択:", agg_prompts)
+        else: # 自由入力
+            selected_agg_prompt = st.text_input(
+                "分析したい観点を入力 (日本語でOK):",
+                placeholder="例: この項目の特徴的な傾向は？"
+            )
+
+        # 分析対象の選択
+        selected_for_agg = st.multiselect(
+            "分析対象の項目を選択してください:",
+            options=AI_AGG_PRODUCTS,
+            default=AI_AGG_PRODUCTS[:4]
+        )
+
+        if st.button(f"🧠 {len(selected_for_agg)}項目を分析", key="ai_agg_button"):
+            if not selected_agg_prompt or selected_agg_prompt.strip() == "":
+                st.error("分析観点を入力または選択してください。")
+            else:
+                with st.spinner(f"AIが{len(selected_for_agg)}項目のトレンドを並列分析中..."):
+                    st.session_state.ai_agg_results = run_ai_agg_bulk_analysis(selected_for_agg, selected_agg_prompt)
+
+        # 分析結果の表示
+        if 'ai_agg_results' in st.session_state and not st.session_state.ai_agg_results.empty:
+            st.markdown("---")
+            st.write(f"**分析結果：**{st.session_state.get('last_agg_prompt', '')}")
+
+            results_df = st.session_state.ai_agg_results
+            for index, row in results_df.iterrows():
+                item_name = row["項目名"]
+                analysis_text = row["AIによるトレンド分析"]
+                st.markdown(AI_AGG_RESULT_HTML.format(title=item_name, body=analysis_text), unsafe_allow_html=True)
+
+        # 実行時のプロンプトを保存（表示用）
+        if 'ai_agg_results' in st.session_state:
+            st.session_state['last_agg_prompt'] = selected_agg_prompt
+
+
+@st.fragment
+def render_data_details(full_df, cpi_attributes):
+    """データ詳細タブを描画"""
+    st.markdown('<div class="section-title">📄 データ詳細</div>', unsafe_allow_html=True)
+
+    # SQL側でDISTINCT・ソート済み
+    all_products = cpi_attributes['PRODUCT'].tolist()
+    # 存在確認はリストを毎回走査せず、一度作ったsetで行う
+    available_products = set(all_products)
+    default_products = [p for p in MAJOR_CPI_PRODUCTS if p in available_products]
+
+    selected_detail_products = st.multiselect(
+        "表示するCPI項目を選択（複数選択可）:",
+        options=all_products,
+        default=default_products,
+        key="multiselect_data_details"
+    )
+
+    if selected_detail_products:
+        # 選択内容とデータが変わらなければリラン時に抽出・並び替えをやり直さない
+        # （選択順に関わらず同じキャッシュを使うよう、項目は並べ替えて渡す）
+        sorted_df = build_detail_table(full_df, tuple(sorted(selected_detail_products)))
+
+        # 修正点②: 日付列の表示形式を 'YYYY-MM-DD' に変更
+        # 表示用のコピーや文字列変換は行わず、CSVと同じフレームを column_config で整形する
+        st.dataframe(
+            sorted_df[['DATE', 'PRODUCT', 'VALUE', 'YoY_Change', 'MoM_Change']].rename(columns={
+                'DATE': '日付', 'PRODUCT': '項目', 'VALUE': 'CPI値',
+                'YoY_Change': '前年同月比(%)', 'MoM_Change': '前月比(%)'
+            }),
+            column_config={'日付': st.column_config.DateColumn(format="YYYY-MM-DD")},
+            use_container_width=True,
+            height=500
         )
-    with cols[3]:
-        st.metric(
-            label=f"エネルギー (YoY) | {metrics['Energy']['Date']:%Y-%m}",
-            value=f"{metrics['Energy']['YoY_Change']:.2f}%",
-            delta=f"{metrics['Energy']['MoM_Change']:.2f}% vs 前月",
+
+        st.markdown("---")
+        # ダウンロードするCSVは元のデータ（sorted_df）を使用
+        csv_data = convert_df_to_csv(sorted_df)
+        st.download_button(
+           label="📥 表示中のデータをCSVとしてダウンロード",
+           data=csv_data,
+           file_name=f"cpi_detail_data_{datetime.now().strftime('%Y%m%d')}.csv",
+           mime="text/csv",
         )
+    else:
+        st.info("⬆️ 上のメニューから表示する項目を1つ以上選択してください。")
 
 
 # --- メインアプリケーション ---
@@ -562,7 +856,9 @@ def main():
     st.markdown('<div class="main-header">🏦 U.S. CPI 分析ダッシュボード</div>', unsafe_allow_html=True)
     st.markdown('<div class="sub-header">金融プロフェッショナル向け | Powered by Snowflake Cortex AI ❄️</div>', unsafe_allow_html=True)
 
-    if not SNOWFLAKE_AVAILABLE:
+    try:
+        get_session()
+    except Exception:
         st.error("⚠️ Snowflakeセッションに接続できません。Snowflake Native App環境で実行してください。")
         st.stop()
         
@@ -575,15 +871,15 @@ def main():
         st.stop()
 
     with st.spinner("❄️ Snowflakeから最新のCPIデータを取得中..."):
-        cpi_df = load_cpi_timeseries_data(start_date, end_date)
+        # YoY / MoM はクエリ内で計算済み
+        full_df = load_cpi_timeseries_data(start_date, end_date)
 
-    if cpi_df.empty:
+    if full_df.empty:
         st.error("データが取得できませんでした。期間を変更するか、管理者にお問い合わせください。")
         st.stop()
         
     with st.spinner("📈 インフレ指標を計算中..."):
-        full_df = calculate_inflation_metrics(cpi_df.copy())
-        contribution_df = calculate_contribution_data(full_df, start_date)
+        contribution_df = calculate_contribution_data(full_df)
         latest_metrics = get_latest_metrics(full_df)
 
     # --- UI表示 ---
@@ -593,168 +889,18 @@ def main():
 
     with tab1:
         st.markdown('<div class="section-title">総合インフレの要因分解</div>', unsafe_allow_html=True)
-        st.markdown("""
-        <div class="info-box">
-        このチャートは、総合CPI（前年同月比）がどの構成要素（エネルギー、食品、コア財、コアサービス）によって変動したかを示します。
-        棒グラフは各項目の「寄与度」を表し、それらの合計が総合CPIの動きと連動します。
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(CONTRIBUTION_INFO_HTML, unsafe_allow_html=True)
         contribution_chart = create_contribution_chart(contribution_df)
-        st.plotly_chart(contribution_chart, use_container_width=True)
+        st.plotly_chart(contribution_chart, use_container_width=True, key="contribution_chart")
 
     with tab2:
-        st.markdown('<div class="section-title">主要項目の価格トレンド</div>', unsafe_allow_html=True)
-        chart_type = st.radio("表示する変化率", ["YoY", "MoM"], horizontal=True, key="trends_radio")
-        
-        trends_df = cpi_df[cpi_df['DATE'] >= pd.to_datetime(start_date)]
-        trends_chart = create_trends_chart(trends_df, chart_type)
-        st.plotly_chart(trends_chart, use_container_width=True)
+        render_trends_section(full_df)
 
     with tab3:
-        st.markdown('<div class="section-title">Cortex AIによる経済分析</div>', unsafe_allow_html=True)
-        st.markdown("""
-        <div class="info-box">
-        SnowflakeのCortex AI関数を活用し、データから専門的な洞察を自動生成します。<br>
-        - <b>全体サマリー分析</b>: <code>AI_COMPLETE</code>を使い、主要KPIからマクロ経済の示唆を導出します。<br>
-        - <b>複数項目の一括分析</b>: <code>AI_AGG</code>を使い、選択した全項目のトレンドを一度のクエリで個別に分析します。
-        </div>
-        """, unsafe_allow_html=True)
-
-        col1, col2 = st.columns([1.2, 1]) 
-        
-        with col1:
-            st.subheader("全体サマリー分析 (AI_COMPLETE)")
-
-            ai_model_complete = st.selectbox(
-                "🧠 使用するAIモデルを選択",
-                ["llama4-maverick", "claude-4-sonnet", "claude-3-5-sonnet", "mistral-large2"],
-                key="model_selector_complete"
-            )
-            
-            if st.button("🧠 サマリー分析を実行", key="ai_complete_button"):
-                with st.spinner(f"AI ({ai_model_complete}) が全体状況を分析中..."):
-                    st.session_state.ai_summary = run_ai_complete_analysis(latest_metrics, ai_model_complete)
-            
-            if 'ai_summary' in st.session_state:
-                st.markdown(f"""
-                <div class="ai-analysis-box" style="white-space: pre-wrap;">
-                    {st.session_state.ai_summary}
-                </div>
-                """, unsafe_allow_html=True)
-
-        with col2:
-            st.subheader("複数項目の一括分析 (AI_AGG)")
-
-            # 分析観点の入力UI（参照コードを参考）
-            agg_input_type = st.radio(
-                "分析観点の指定方法:",
-                ["サンプルから選択", "自由入力"],
-                horizontal=True,
-                key="agg_input_type"
-            )
-
-            if agg_input_type == "サンプルから選択":
-                agg_prompts = [
-                    "最近のトレンドを150字程度で要約して。",
-                    "価格を押し上げている主な要因は何ですか？",
-                    "価格を安定させている主な要因は何ですか？",
-                    "この項目の価格変動は、他の経済指標（例：個人消費支出、生産者物価指数）にどのような影響を与えそうですか？",
-                    "このデータは、FRBの次の金融政策決定会合（FOMC）にどのような影響を与えますか？"
-                ]
-                selected_agg_prompt = st.selectbox("分析観点を選択:", agg_prompts)
-            else: # 自由入力
-                selected_agg_prompt = st.text_input(
-                    "分析したい観点を入力 (日本語でOK):",
-                    placeholder="例: この項目の特徴的な傾向は？"
-                )
-
-            # 分析対象の選択
-            products_for_agg = ['All items', 'All items less food and energy', 'Food', 'Energy', 'Services less energy services', 'Commodities less food and energy commodities']
-            selected_for_agg = st.multiselect(
-                "分析対象の項目を選択してください:",
-                options=products_for_agg,
-                default=products_for_agg[:4] 
-            )
-            
-            if st.button(f"🧠 {len(selected_for_agg)}項目を分析", key="ai_agg_button"):
-                if not selected_agg_prompt or selected_agg_prompt.strip() == "":
-                    st.error("分析観点を入力または選択してください。")
-                else:
-                    with st.spinner(f"AIが{len(selected_for_agg)}項目のトレンドを並列分析中..."):
-                        st.session_state.ai_agg_results = run_ai_agg_bulk_analysis(selected_for_agg, selected_agg_prompt)
-
-            # 分析結果の表示
-            if 'ai_agg_results' in st.session_state and not st.session_state.ai_agg_results.empty:
-                st.markdown("---")
-                st.write(f"**分析結果：**{st.session_state.get('last_agg_prompt', '')}")
-                
-                results_df = st.session_state.ai_agg_results
-                for index, row in results_df.iterrows():
-                    item_name = row["項目名"]
-                    analysis_text = row["AIによるトレンド分析"]
-                    cleaned_text = analysis_text.replace('**', '').replace('*', '').replace('\\', '').replace('_', '').replace('#', '')
-                    
-                    st.markdown(f"""
-                    <div class="ai-analysis-box" style="margin-bottom: 1rem; white-space: pre-wrap;">
-                        <h5 style="margin-top:0; margin-bottom: 0.5rem;">{item_name}</h5>
-                        {analysis_text}
-                    </div>
-                    """, unsafe_allow_html=True)
-
-            # 実行時のプロンプトを保存（表示用）
-            if 'ai_agg_results' in st.session_state:
-                st.session_state['last_agg_prompt'] = selected_agg_prompt
+        render_ai_insights(latest_metrics)
 
     with tab4:
-        st.markdown('<div class="section-title">📄 データ詳細</div>', unsafe_allow_html=True)
+        render_data_details(full_df, cpi_attributes)
 
-        all_products = sorted(cpi_attributes['PRODUCT'].unique())
-        major_products = get_major_cpi_products()
-        default_products = [p for p in major_products if p in all_products]
-
-        selected_detail_products = st.multiselect(
-            "表示するCPI項目を選択（複数選択可）:",
-            options=all_products,
-            default=default_products,
-            key="multiselect_data_details"
-        )
-
-        if selected_detail_products:
-            display_df = full_df[full_df['PRODUCT'].isin(selected_detail_products)]
-            
-            # 日付の新しい順に並び替え
-            sorted_df = display_df.sort_values(by="DATE", ascending=False)
-
-            # 修正点①: 古いインデックスをリセットして、1から始まる連番にする
-            sorted_df = sorted_df.reset_index(drop=True)
-            
-            # 表示用にデータフレームをコピー
-            df_for_display = sorted_df.copy()
-
-            # 修正点②: 日付列の表示形式を 'YYYY-MM-DD' に変更
-            df_for_display['DATE'] = df_for_display['DATE'].dt.strftime('%Y-%m-%d')
-
-            # 整形したデータフレームを表示
-            st.dataframe(
-                df_for_display[['DATE', 'PRODUCT', 'VALUE', 'YoY_Change', 'MoM_Change']].rename(columns={
-                    'DATE': '日付', 'PRODUCT': '項目', 'VALUE': 'CPI値',
-                    'YoY_Change': '前年同月比(%)', 'MoM_Change': '前月比(%)'
-                }),
-                use_container_width=True,
-                height=500
-            )
-
-            st.markdown("---")
-            # ダウンロードするCSVは元のデータ（sorted_df）を使用
-            csv_data = sorted_df.to_csv(index=False).encode('utf-8')
-            st.download_button(
-               label="📥 表示中のデータをCSVとしてダウンロード",
-               data=csv_data,
-               file_name=f"cpi_detail_data_{datetime.now().strftime('%Y%m%d')}.csv",
-               mime="text/csv",
-            )
-        else:
-            st.info("⬆️ 上のメニューから表示する項目を1つ以上選択してください。")
-        
 if __name__ == "__main__":
     main()